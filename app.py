@@ -1,58 +1,393 @@
+from __future__ import annotations
+
+import hashlib
+import html
+import io
+import math
 import os
 import zipfile
-import tempfile
 import logging
-import json
 import re
-from pathlib import Path
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-from flask import Flask, request, render_template_string
+import orjson
+from flask import Flask, Request, Response, request, render_template_string, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from google.api_core.exceptions import NotFound
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
 from google.oauth2 import service_account
+from PIL import Image
+
+if TYPE_CHECKING:
+    from google.cloud import storage
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+SUPPORTED_SUFFIXES = tuple(SUPPORTED_EXTENSIONS)  # For str.endswith, which takes a tuple
+VISION_BATCH_SIZE = 16  # Maximum number of images Vision accepts per batch_annotate_images call
+UPLOAD_SPOOL_BYTES = 16 * 1024 * 1024  # Uploads larger than this are written to a temporary file
+# Cap on the images' declared uncompressed size. ZipExtFile never inflates a member past its declared
+# size, so this bounds memory even for zip bombs; no compression-ratio check, since BMP pages deflate >100x.
+MAX_ARCHIVE_IMAGE_BYTES = int(os.getenv("MAX_ARCHIVE_IMAGE_BYTES", str(500 * 1024 * 1024)))
+OCR_MAX_DIMENSION = 2000  # Long edge (px) above which pages are downscaled before OCR
+OCR_JPEG_QUALITY = 85
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", "8"))  # Concurrent Vision requests per upload
+# gRPC options for the shared Vision channel: keepalive pings stop idle connections being torn down
+# between uploads, and -1 keeps the client library's default of unlimited message sizes.
+VISION_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+DEFAULT_LANGUAGE_HINTS = os.getenv("OCR_LANGUAGE_HINTS", "en")  # Comma-separated; overridden per upload by ?lang=
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "1024"))  # Pages whose OCR text is kept in memory
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR")  # Optional directory that persists OCR text across restarts and workers
+OCR_CACHE_DIR_MAX_BYTES = int(os.getenv("OCR_CACHE_DIR_MAX_BYTES", str(1024 * 1024 * 1024)))  # Least recently used entries are pruned beyond this
+OCR_CACHE_VERSION = "v1:document_text_detection"
+# Enables the asynchronous /jobs endpoint when set. Uploaded pages are deleted once /status sees the job
+# finish, but each job's job.json and Vision output stay so the results can be fetched again; give the
+# bucket a lifecycle rule (e.g. delete objects older than 7 days) to expire them.
+GCS_BUCKET = os.getenv("GCS_BUCKET")
+ASYNC_OUTPUT_BATCH_SIZE = 100  # Responses per output JSON file written by Vision to GCS
+
+# Google clients are created once per worker process and shared by all request threads.
+_client_lock = threading.Lock()
+_vision_client = None
+_storage_client = None
+
+# OCR text keyed by a hash of the page bytes, shared across requests (least recently used evicted first).
+_ocr_cache = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+# Approximate size of OCR_CACHE_DIR as seen by this process; rescanned whenever the disk cache is pruned.
+_disk_cache_bytes = None
+_disk_cache_lock = threading.Lock()
+
+_NUM_RE = re.compile(r'(\d+)')
+_JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+class OrjsonProvider(JSONProvider):
+    """Serializes Flask JSON responses (e.g. /status page lists) with orjson."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class UploadRequest(Request):
+    """Buffers uploads in a BytesIO or TemporaryFile, both of which zipfile can read in place.
+
+    Werkzeug's default SpooledTemporaryFile has no seekable() before Python 3.11, which zipfile requires.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+            return io.BytesIO()
+        return tempfile.TemporaryFile("w+b")
 
 # Initialize Flask App
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.json = OrjsonProvider(app)
 
 # --- Helper Functions ---
 
 def natural_sort_key(s: str) -> list:
     """Sorts strings with numbers in a natural way (e.g., page2 before page10)."""
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+    return [int(text) if text.isdigit() else text.lower() for text in _NUM_RE.split(s)]
 
-def initialize_vision_client():
-    """Initializes the Vision API client safely from environment variables."""
+@lru_cache(maxsize=1)
+def load_credentials():
+    """Loads service account credentials safely from environment variables (parsed once per process).
+
+    Returns None when GOOGLE_APPLICATION_CREDENTIALS_JSON is not set, so the Google clients fall back
+    to Application Default Credentials (a mounted key file or the platform's workload identity).
+    """
     credentials_json_str = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
     if not credentials_json_str:
-        logging.critical("CRITICAL: GOOGLE_APPLICATION_CREDENTIALS_JSON environment variable is not set.")
-        raise EnvironmentError("Google Cloud credentials not found in environment.")
-    
+        logging.info("GOOGLE_APPLICATION_CREDENTIALS_JSON is not set; using Application Default Credentials.")
+        return None
+    credentials_info = orjson.loads(credentials_json_str)
+    return service_account.Credentials.from_service_account_info(credentials_info)
+
+def initialize_vision_client():
+    """Initializes the Vision API client from the configured or default credentials."""
     try:
-        credentials_info = json.loads(credentials_json_str)
-        credentials = service_account.Credentials.from_service_account_info(credentials_info)
-        client = vision.ImageAnnotatorClient(credentials=credentials)
+        channel = ImageAnnotatorGrpcTransport.create_channel(credentials=load_credentials(), options=VISION_CHANNEL_OPTIONS)
+        client = vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
         logging.info("Google Cloud Vision client initialized successfully.")
         return client
     except Exception as e:
         logging.critical(f"Failed to initialize Google Vision client: {e}")
         raise
 
-def extract_text_from_image(client: vision.ImageAnnotatorClient, image_path: Path) -> str:
-    """Uses Google Cloud Vision API to perform OCR on a single image."""
+def initialize_storage_client():
+    """Initializes the Cloud Storage client used for asynchronous OCR jobs."""
+    # Imported here so processes that never enable /jobs don't pay for loading the Storage library.
+    from google.cloud import storage
+
+    try:
+        credentials = load_credentials()
+        project = credentials.project_id if credentials else None
+        client = storage.Client(project=project, credentials=credentials)
+        logging.info("Google Cloud Storage client initialized successfully.")
+        return client
+    except Exception as e:
+        logging.critical(f"Failed to initialize Google Cloud Storage client: {e}")
+        raise
+
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    """Returns the shared Vision client, initializing it on first use."""
+    global _vision_client
+    if _vision_client is None:
+        with _client_lock:
+            if _vision_client is None:
+                _vision_client = initialize_vision_client()
+    return _vision_client
+
+def get_storage_client() -> storage.Client:
+    """Returns the shared Cloud Storage client, initializing it on first use."""
+    global _storage_client
+    if _storage_client is None:
+        with _client_lock:
+            if _storage_client is None:
+                _storage_client = initialize_storage_client()
+    return _storage_client
+
+def page_name(member: zipfile.ZipInfo) -> str:
+    """Returns the base name of a zip entry (zip paths always use '/', so no Path object is needed)."""
+    return member.filename.rpartition('/')[2]
+
+def list_image_pages(zip_ref: zipfile.ZipFile) -> list[tuple[str, zipfile.ZipInfo]]:
+    """Returns (page name, entry) pairs for the archive's supported images in natural page order, without extracting anything.
+
+    Each name is computed once here and carried alongside its entry through OCR and output.
+
+    Raises ValueError if the images' declared uncompressed size exceeds MAX_ARCHIVE_IMAGE_BYTES.
+    """
+    members = zip_ref.infolist()
+    image_members = [
+        m for m in members
+        if m.filename.lower().endswith(SUPPORTED_SUFFIXES)  # Directory entries end in '/' and never match
+        and not m.filename.startswith('__MACOSX/')  # macOS resource forks reuse the image names
+    ]
+    # Reject oversized archives and zip bombs from the central directory, before any member is read.
+    total_size = sum(m.file_size for m in image_members)
+    if total_size > MAX_ARCHIVE_IMAGE_BYTES:
+        raise ValueError(f"The archive's images total {total_size // (1024 * 1024)} MiB uncompressed, "
+                         f"over the {MAX_ARCHIVE_IMAGE_BYTES // (1024 * 1024)} MiB limit.")
+    pages = [(page_name(m), m) for m in image_members]
+    pages.sort(key=lambda page: natural_sort_key(page[0]))
+    # One summary line per archive rather than a log line per entry.
+    logging.info(f"Found {len(pages)} images in archive ({len(members) - len(pages)} other entries skipped)")
+    return pages
+
+def flatten_to_rgb(im: Image.Image) -> Image.Image:
+    """Converts an image to RGB, compositing any transparency onto white (a plain convert turns it black)."""
+    if im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info:
+        rgba = im.convert('RGBA')
+        page = Image.new('RGB', im.size, 'white')
+        page.paste(rgba, mask=rgba.getchannel('A'))
+        return page
+    return im.convert('RGB')
+
+def prepare_for_ocr(content: bytes) -> bytes:
+    """Downscales oversized pages and re-encodes them as JPEG to shrink the payload sent to Vision."""
+    try:
+        with Image.open(io.BytesIO(content)) as im:
+            if max(im.size) <= OCR_MAX_DIMENSION:
+                return content
+            im.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+            buf = io.BytesIO()
+            flatten_to_rgb(im).save(buf, 'JPEG', quality=OCR_JPEG_QUALITY)
+            return buf.getvalue()
+    except Exception as e:
+        # Vision may still cope with images Pillow can't decode, so fall back to the original bytes.
+        logging.warning(f"Could not downscale image, sending it unchanged: {e}")
+        return content
+
+def parse_language_hints(raw: str) -> list[str]:
+    """Splits a comma-separated language list (e.g. "en,ja"); an empty list lets Vision detect the language."""
+    return [hint.strip() for hint in raw.split(',') if hint.strip()]
+
+def ocr_cache_key(content: bytes, language_hints: list[str]) -> str:
+    """Returns the cache key for an image's raw bytes and the language hints it is read with."""
+    digest = hashlib.blake2b(digest_size=16)
+    # The version tag invalidates old entries whenever the OCR request itself changes.
+    digest.update(f"{OCR_CACHE_VERSION}:{','.join(language_hints)}:".encode())
+    digest.update(content)
+    return digest.hexdigest()
+
+def ocr_cache_path(key: str) -> str:
+    """Returns the on-disk location of a cache entry, sharded by the key's first two characters."""
+    return os.path.join(OCR_CACHE_DIR, key[:2], f"{key}.txt")
+
+def get_cached_text(key: str):
+    """Returns previously extracted text for a cache key from memory or the disk cache, or None."""
+    with _ocr_cache_lock:
+        text = _ocr_cache.get(key)
+        if text is not None:
+            _ocr_cache.move_to_end(key)
+            return text
+    if not OCR_CACHE_DIR:
+        return None
+    path = ocr_cache_path(key)
+    try:
+        # Binary, like cache_text writes it, so newline translation can't alter \r\n or \r in the text.
+        with open(path, "rb") as cache_file:
+            text = cache_file.read().decode("utf-8")
+        os.utime(path)  # Marks the entry as recently used for pruning
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError) as e:
+        logging.warning(f"Could not read OCR cache entry {key}: {e}")
+        return None
+    cache_text(key, text, persist=False)
+    return text
+
+def cache_text(key: str, text: str, persist: bool = True):
+    """Stores extracted text, evicting the least recently used entry when the cache is full."""
+    with _ocr_cache_lock:
+        _ocr_cache[key] = text
+        _ocr_cache.move_to_end(key)
+        if len(_ocr_cache) > OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+    if not (persist and OCR_CACHE_DIR):
+        return
+    path = ocr_cache_path(key)
+    # Write then rename so concurrent readers never see a partial entry.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    data = text.encode("utf-8")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Could not write OCR cache entry {key}: {e}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return
+    track_disk_cache_write(len(data))
+
+def disk_cache_entries() -> list[tuple[float, int, str]]:
+    """Returns (mtime, size, path) for every entry in the disk cache."""
+    entries = []
+    with os.scandir(OCR_CACHE_DIR) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as files:
+                for entry in files:
+                    if entry.name.endswith(".txt"):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue  # Pruned by another worker
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+def prune_disk_cache() -> int:
+    """Deletes the least recently used disk cache entries until the cache is under 90% of its limit; returns its new size."""
+    entries = sorted(disk_cache_entries())
+    total = sum(size for _, size, _ in entries)
+    target = OCR_CACHE_DIR_MAX_BYTES * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+def track_disk_cache_write(size: int):
+    """Adds a new entry to this process's view of the disk cache size, pruning it once over OCR_CACHE_DIR_MAX_BYTES."""
+    global _disk_cache_bytes
+    with _disk_cache_lock:
+        try:
+            if _disk_cache_bytes is None:
+                _disk_cache_bytes = sum(size for _, size, _ in disk_cache_entries())
+            else:
+                _disk_cache_bytes += size
+            if _disk_cache_bytes > OCR_CACHE_DIR_MAX_BYTES:
+                _disk_cache_bytes = prune_disk_cache()
+        except OSError as e:
+            logging.warning(f"Could not prune OCR disk cache: {e}")
+
+def page_error(name: str, error) -> str:
+    """Returns the inline marker shown in place of a page's text when it could not be processed."""
+    return f"[Error processing {name}: {error}]"
+
+def response_text(image_response: vision.AnnotateImageResponse, name: str) -> str:
+    """Returns the OCR text of a single Vision response, or an inline error marker."""
+    if image_response.error.message:
+        logging.error(f"Could not process image {name} with Vision API: {image_response.error.message}")
+        return page_error(name, image_response.error.message)
+    return image_response.full_text_annotation.text
+
+def extract_text_from_images(client: vision.ImageAnnotatorClient, images: list[tuple[str, bytes]], language_hints: list[str]) -> list[str]:
+    """Uses Google Cloud Vision API to perform OCR on a batch of (name, content) images in a single request.
+
+    Pages seen before (e.g. repeated ads or re-uploaded zips) are served from the OCR cache and left out of the request.
+    """
+    keys = [ocr_cache_key(content, language_hints) for _, content in images]
+    texts = [get_cached_text(key) for key in keys]
+    # Uncached key -> indexes of the pages with it, so a page repeated within the batch is only sent once.
+    misses = {}
+    for i, text in enumerate(texts):
+        if text is None:
+            misses.setdefault(keys[i], []).append(i)
+    if not misses:
+        return texts
+
+    # Known languages let Vision skip language identification.
+    image_context = vision.ImageContext(language_hints=language_hints)
+    annotate_requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(content=prepare_for_ocr(images[indexes[0]][1])),
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+            image_context=image_context,
+        )
+        for indexes in misses.values()
+    ]
+
+    try:
+        response = client.batch_annotate_images(requests=annotate_requests)
+    except Exception as e:
+        logging.error(f"Vision API batch request failed for {len(misses)} images: {e}")
+        for indexes in misses.values():
+            for i in indexes:
+                texts[i] = page_error(images[i][0], e)
+        return texts
+
+    for (key, indexes), image_response in zip(misses.items(), response.responses):
+        for i in indexes:
+            texts[i] = response_text(image_response, images[i][0])
+        if not image_response.error.message:
+            cache_text(key, texts[indexes[0]])
+    return texts
+
+def discard_job(bucket: storage.Bucket, job_id: str, folder: str = ""):
+    """Deletes a job's GCS objects (or only those under `folder`, e.g. "in/"), logging rather than raising on failure."""
     try:
-        with open(image_path, "rb") as image_file:
-            content = image_file.read()
-        image = vision.Image(content=content)
-        response = client.document_text_detection(image=image)
-        if response.error.message:
-            raise Exception(response.error.message)
-        return response.full_text_annotation.text
+        for blob in bucket.list_blobs(prefix=f"{job_id}/{folder}"):
+            blob.delete()
     except Exception as e:
-        logging.error(f"Could not process image {image_path.name} with Vision API: {e}")
-        return f"[Error processing {image_path.name}: {e}]"
+        logging.warning(f"Could not clean up GCS objects of job {job_id}: {e}")
 
 # --- Web App Routes ---
 
@@ -99,40 +434,223 @@ def upload_and_process():
     file = request.files['file']
     if file.filename == '' or not file.filename.endswith('.zip'):
         return "No selected file or file is not a zip", 400
+    language_hints = parse_language_hints(request.args.get('lang', DEFAULT_LANGUAGE_HINTS))
 
     try:
-        client = initialize_vision_client()
+        client = get_vision_client()
     except Exception as e:
         return f"<h1>Error</h1><p>Could not initialize OCR service. Check server configuration.</p><pre>{e}</pre>", 500
     
-    final_text = f"<h1>OCR Results for {file.filename}</h1>\n<pre>"
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_path = Path(tmpdir)
-        zip_path = tmp_path / file.filename
-        file.save(zip_path)
-
-        logging.info(f"Extracting '{zip_path.name}'...")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(tmp_path)
-        
-        image_files = sorted(
-            [p for p in tmp_path.glob('**/*') if p.suffix.lower() in SUPPORTED_EXTENSIONS],
-            key=lambda x: natural_sort_key(x.name)
+    # Pages are read and OCR'd from generate() below, which runs after this view has returned and
+    # the request has closed its uploaded files. The generator therefore takes over the upload's
+    # stream, leaving an empty one for request teardown to close, and closes the archive itself.
+    filename = file.filename
+    archive, file.stream = file.stream, io.BytesIO()
+    archive.seek(0)
+    try:
+        zip_ref = zipfile.ZipFile(archive, 'r')
+    except zipfile.BadZipFile:
+        archive.close()
+        return "<h1>Error</h1><p>Uploaded file is not a valid ZIP archive.</p>", 400
+
+    try:
+        pages = list_image_pages(zip_ref)
+    except ValueError as e:
+        zip_ref.close()
+        archive.close()
+        return f"<h1>Error</h1><p>{html.escape(str(e))}</p>", 400
+    if not pages:
+        zip_ref.close()
+        archive.close()
+        return "<h1>Error</h1><p>No supported image files (.jpg, .png, etc.) found in the zip archive.</p>", 400
+
+    def ocr_batch(batch):
+        # Image bytes are read straight from the archive; nothing is extracted to disk. The response is
+        # already streaming, so a member that can't be read (encrypted, unsupported compression, bad CRC)
+        # gets an inline error marker instead of aborting the page.
+        images, read_errors = [], {}
+        for i, (name, member) in enumerate(batch):
+            try:
+                images.append((name, zip_ref.read(member)))
+            except Exception as e:
+                logging.error(f"Could not read {name} from the archive: {e}")
+                read_errors[i] = page_error(name, e)
+        texts = iter(extract_text_from_images(client, images, language_hints))
+        return [read_errors[i] if i in read_errors else next(texts) for i in range(len(batch))]
+
+    # Spread small jobs over every worker (e.g. 20 pages -> 7 batches of 3, not 16 + 4) and cap at Vision's batch limit.
+    batch_size = min(VISION_BATCH_SIZE, math.ceil(len(pages) / OCR_MAX_WORKERS))
+    batches = [pages[start:start + batch_size] for start in range(0, len(pages), batch_size)]
+    logging.info(f"Processing {len(pages)} pages in {len(batches)} Vision batches...")
+
+    def generate():
+        # The Vision client is thread-safe and the work is network-bound, so batches run concurrently.
+        # ZipFile serializes the underlying reads, so workers can share zip_ref.
+        # Executor.map yields results in submission order, so pages stream out in sequence
+        # as soon as their batch (and every batch before it) has finished.
+        executor = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS)
+        try:
+            yield f"<h1>OCR Results for {html.escape(filename)}</h1>\n<pre>"
+            page = 0
+            for batch, texts in zip(batches, executor.map(ocr_batch, batches)):
+                # One chunk per batch keeps the number of response writes proportional to batches, not pages.
+                chunk = []
+                for (name, _), text in zip(batch, texts):
+                    page += 1
+                    chunk.append(f"\n--- Page {page}: {html.escape(name)} ---\n\n{html.escape(text, quote=False)}\n\n")
+                yield ''.join(chunk)
+            yield "</pre>"
+        finally:
+            # If the client disconnects, skip batches that haven't started; running ones still read zip_ref.
+            executor.shutdown(wait=True, cancel_futures=True)
+            zip_ref.close()
+            archive.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+@app.route('/jobs', methods=['POST'])
+def submit_async_job():
+    """Uploads the zip's images to Cloud Storage and starts an asynchronous Vision OCR job."""
+    if not GCS_BUCKET:
+        return jsonify({"error": "Asynchronous jobs are not enabled (GCS_BUCKET is not set)."}), 503
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+    file = request.files['file']
+    if file.filename == '' or not file.filename.endswith('.zip'):
+        return jsonify({"error": "No selected file or file is not a zip"}), 400
+    language_hints = parse_language_hints(request.args.get('lang', DEFAULT_LANGUAGE_HINTS))
+
+    try:
+        client = get_vision_client()
+        bucket = get_storage_client().bucket(GCS_BUCKET)
+    except Exception as e:
+        return jsonify({"error": f"Could not initialize OCR service: {e}"}), 500
+
+    job_id = uuid.uuid4().hex
+    file.stream.seek(0)
+    try:
+        zip_ref = zipfile.ZipFile(file.stream, 'r')
+    except zipfile.BadZipFile:
+        return jsonify({"error": "Uploaded file is not a valid ZIP archive."}), 400
+    with zip_ref:
+        try:
+            pages = list_image_pages(zip_ref)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not pages:
+            return jsonify({"error": "No supported image files (.jpg, .png, etc.) found in the zip archive."}), 400
+
+        page_names = [name for name, _ in pages]
+        # The page index prefix keeps blob names unique and in page order.
+        blob_names = [f"{job_id}/in/{i:05d}-{name}" for i, name in enumerate(page_names)]
+
+        def upload_page(blob_name, page):
+            name, member = page
+            try:
+                content = zip_ref.read(member)
+            except Exception as e:
+                raise ValueError(f"Could not read {name} from the archive: {e}") from e
+            bucket.blob(blob_name).upload_from_string(prepare_for_ocr(content))
+
+        logging.info(f"Uploading {len(pages)} images to gs://{GCS_BUCKET}/{job_id}/in/...")
+        try:
+            with ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS) as executor:
+                list(executor.map(upload_page, blob_names, pages))
+        except ValueError as e:
+            discard_job(bucket, job_id)
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            logging.error(f"Could not upload images for job {job_id}: {e}")
+            discard_job(bucket, job_id)
+            return jsonify({"error": f"Could not upload images: {e}"}), 500
+
+    image_context = vision.ImageContext(language_hints=language_hints)
+    annotate_requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(source=vision.ImageSource(image_uri=f"gs://{GCS_BUCKET}/{name}")),
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+            image_context=image_context,
         )
+        for name in blob_names
+    ]
+    output_config = vision.OutputConfig(
+        gcs_destination=vision.GcsDestination(uri=f"gs://{GCS_BUCKET}/{job_id}/out/"),
+        batch_size=ASYNC_OUTPUT_BATCH_SIZE,
+    )
+    try:
+        operation = client.async_batch_annotate_images(requests=annotate_requests, output_config=output_config)
+    except Exception as e:
+        logging.error(f"Could not start asynchronous OCR job {job_id}: {e}")
+        discard_job(bucket, job_id)
+        return jsonify({"error": f"Could not start OCR job: {e}"}), 500
+
+    # Job state lives next to the job's images in GCS, so any Gunicorn worker or instance can answer /status.
+    manifest = {"operation": operation.operation.name, "pages": page_names}
+    try:
+        bucket.blob(f"{job_id}/job.json").upload_from_string(orjson.dumps(manifest), content_type="application/json")
+    except Exception as e:
+        logging.error(f"Could not save manifest of OCR job {job_id}: {e}")
+        # Without a manifest the job can never be polled, so stop the operation instead of orphaning it.
+        try:
+            operation.cancel()
+        except Exception as cancel_error:
+            logging.warning(f"Could not cancel operation {operation.operation.name}: {cancel_error}")
+        discard_job(bucket, job_id)
+        return jsonify({"error": f"Could not save OCR job: {e}"}), 500
+    logging.info(f"Started asynchronous OCR job {job_id} ({operation.operation.name})")
+    return jsonify({"job_id": job_id, "operation": operation.operation.name}), 202
+
+@app.route('/status/<job_id>', methods=['GET'])
+def async_job_status(job_id):
+    """Reports the state of an asynchronous OCR job and returns its text once finished."""
+    if not GCS_BUCKET:
+        return jsonify({"error": "Asynchronous jobs are not enabled (GCS_BUCKET is not set)."}), 503
+    if not _JOB_ID_RE.fullmatch(job_id):
+        return jsonify({"error": "Unknown job id"}), 404
+
+    try:
+        client = get_vision_client()
+        bucket = get_storage_client().bucket(GCS_BUCKET)
+    except Exception as e:
+        return jsonify({"error": f"Could not initialize OCR service: {e}"}), 500
+
+    try:
+        job = orjson.loads(bucket.blob(f"{job_id}/job.json").download_as_bytes())
+    except NotFound:
+        return jsonify({"error": "Unknown job id"}), 404
+    except Exception as e:
+        logging.error(f"Could not load manifest of OCR job {job_id}: {e}")
+        return jsonify({"error": f"Could not load OCR job: {e}"}), 500
+
+    try:
+        operation = client.transport.operations_client.get_operation(job["operation"])
+    except Exception as e:
+        logging.error(f"Could not check operation of OCR job {job_id}: {e}")
+        return jsonify({"error": f"Could not check OCR job status: {e}"}), 500
+    if not operation.done:
+        return jsonify({"job_id": job_id, "status": "running"})
+    # Vision has finished reading the pages, so only the manifest and output need to stay.
+    discard_job(bucket, job_id, "in/")
+    if operation.error.code:
+        # The status query itself succeeded; the failure belongs to the job.
+        return jsonify({"job_id": job_id, "status": "failed", "error": operation.error.message})
+
+    try:
+        # Vision writes output-1-to-100.json, output-101-to-200.json, ... in request order.
+        output_blobs = sorted(bucket.list_blobs(prefix=f"{job_id}/out/"), key=lambda b: natural_sort_key(b.name))
+        responses = []
+        for blob in output_blobs:
+            batch_response = vision.BatchAnnotateImagesResponse.from_json(blob.download_as_text(), ignore_unknown_fields=True)
+            responses.extend(batch_response.responses)
+    except Exception as e:
+        logging.error(f"Could not read results of OCR job {job_id}: {e}")
+        return jsonify({"error": f"Could not read OCR job results: {e}"}), 500
 
-        if not image_files:
-            return "<h1>Error</h1><p>No supported image files (.jpg, .png, etc.) found in the zip archive.</p>", 400
-        
-        for i, image_path in enumerate(image_files):
-            logging.info(f"Processing page {i+1}/{len(image_files)}: {image_path.name}")
-            final_text += f"\n--- Page {i+1}: {image_path.name} ---\n\n"
-            text = extract_text_from_image(client, image_path)
-            final_text += text.replace('<', '&lt;').replace('>', '&gt;') # Basic HTML escaping
-            final_text += "\n\n"
-
-    final_text += "</pre>"
-    return final_text
+    pages = [
+        {"page": i + 1, "name": name, "text": response_text(r, name)}
+        for i, (name, r) in enumerate(zip(job["pages"], responses))
+    ]
+    return jsonify({"job_id": job_id, "status": "done", "pages": pages})
 
 if __name__ == "__main__":
     # Kinsta will use a production server like Gunicorn, not this.
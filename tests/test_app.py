@@ -0,0 +1,362 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from google.longrunning import operations_pb2
+from google.rpc import status_pb2
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeVisionClient:
+    """Stands in for ImageAnnotatorClient, answering each image with its position in the upload."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def batch_annotate_images(self, requests):
+        responses = []
+        for _ in requests:
+            self.calls += 1
+            responses.append(app.vision.AnnotateImageResponse(
+                full_text_annotation=app.vision.TextAnnotation(text=f"text {self.calls}")
+            ))
+        return app.vision.BatchAnnotateImagesResponse(responses=responses)
+
+
+class FakeOperation:
+    """Stands in for the long-running operation returned by async_batch_annotate_images."""
+
+    def __init__(self):
+        self.operation = mock.Mock()
+        self.operation.name = "operations/fake"
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeBucket:
+    """Stands in for a storage.Bucket, keeping blobs in memory and failing uploads whose name contains `fail_on`."""
+
+    def __init__(self, fail_on=None):
+        self.blobs = {}
+        self.fail_on = fail_on
+
+    def blob(self, name):
+        bucket = self
+        blob = mock.Mock()
+        blob.name = name
+
+        def upload_from_string(data, content_type=None):
+            if bucket.fail_on and bucket.fail_on in name:
+                raise RuntimeError("upload refused")
+            bucket.blobs[name] = data
+
+        def download():
+            if name not in bucket.blobs:
+                raise app.NotFound(name)
+            return bucket.blobs[name]
+
+        blob.upload_from_string.side_effect = upload_from_string
+        blob.download_as_bytes.side_effect = download
+        blob.download_as_text.side_effect = lambda: download().decode()
+        blob.delete.side_effect = lambda: bucket.blobs.pop(name, None)
+        return blob
+
+    def list_blobs(self, prefix):
+        return [self.blob(name) for name in list(self.blobs) if name.startswith(prefix)]
+
+
+def png_bytes(shade: int) -> bytes:
+    buf = io.BytesIO()
+    Image.new('RGB', (10, 10), (shade, shade, shade)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def make_zip(files: dict, compression=zipfile.ZIP_STORED) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    buf.seek(0)
+    return buf
+
+
+class UploadAndProcessTests(unittest.TestCase):
+    def setUp(self):
+        app._ocr_cache.clear()
+        app._vision_client = FakeVisionClient()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app._vision_client = None
+
+    def post_zip(self, archive: io.BytesIO, query: str = ''):
+        return self.client.post(f'/{query}', data={'file': (archive, 'comic.zip')}, content_type='multipart/form-data')
+
+    def test_streams_every_page_in_natural_order(self):
+        archive = make_zip({'p10.png': png_bytes(1), 'p2.png': png_bytes(2), 'p1.png': png_bytes(3)})
+        response = self.post_zip(archive)
+        body = response.get_data(as_text=True)  # Consumes the stream, after the request context is gone
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(body.endswith("</pre>"))
+        self.assertLess(body.index("p1.png"), body.index("p2.png"))
+        self.assertLess(body.index("p2.png"), body.index("p10.png"))
+        self.assertEqual(body.count("--- Page"), 3)
+
+    def test_streams_uploads_buffered_in_a_temporary_file(self):
+        archive = make_zip({'p1.png': png_bytes(1), 'p2.png': png_bytes(2)})
+        with mock.patch.object(app, 'UPLOAD_SPOOL_BYTES', 0):  # Large uploads go to a TemporaryFile
+            body = self.post_zip(archive).get_data(as_text=True)
+        self.assertTrue(body.endswith("</pre>"))
+        self.assertEqual(body.count("--- Page"), 2)
+
+    def test_unreadable_member_gets_inline_error(self):
+        archive = make_zip({'p1.png': png_bytes(1), 'p2.png': png_bytes(2), 'p3.png': png_bytes(3)})
+        raw = bytearray(archive.getvalue())
+        # Corrupt p2.png's stored data so zip_ref.read() fails its CRC check.
+        with zipfile.ZipFile(io.BytesIO(bytes(raw))) as zf:
+            member = zf.getinfo('p2.png')
+        data_start = member.header_offset + 30 + len(member.filename) + len(member.extra)
+        raw[data_start + 20] ^= 0xFF
+
+        with mock.patch.object(app, 'OCR_MAX_WORKERS', 1):  # Put all pages in one batch
+            body = self.post_zip(io.BytesIO(bytes(raw))).get_data(as_text=True)
+
+        self.assertTrue(body.endswith("</pre>"))
+        self.assertIn("[Error processing p2.png:", body)
+        self.assertEqual(body.count("--- Page"), 3)
+        self.assertIn("text 2", body)  # p3.png is still OCR'd after the failed member
+
+    def test_repeated_pages_are_served_from_the_cache(self):
+        pages = {'p1.png': png_bytes(1), 'p2.png': png_bytes(2), 'p3.png': png_bytes(1)}
+        vision_client = app._vision_client
+        with mock.patch.object(app, 'OCR_MAX_WORKERS', 1):  # Put all pages in one batch
+            first = self.post_zip(make_zip(pages)).get_data(as_text=True)
+            self.assertEqual(vision_client.calls, 2)  # p3.png repeats p1.png
+            self.assertEqual(first.count("text 1"), 2)
+
+            self.assertEqual(self.post_zip(make_zip(pages)).get_data(as_text=True), first)
+            self.assertEqual(vision_client.calls, 2)
+
+            self.post_zip(make_zip(pages), '?lang=ja').get_data()
+            self.assertEqual(vision_client.calls, 4)  # Language hints are part of the cache key
+
+    def test_disk_cache_survives_a_cleared_memory_cache(self):
+        pages = {'p1.png': png_bytes(1), 'p2.png': png_bytes(2)}
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.object(app, 'OCR_CACHE_DIR', cache_dir), \
+                mock.patch.object(app, '_disk_cache_bytes', None):
+            first = self.post_zip(make_zip(pages)).get_data(as_text=True)
+            app._ocr_cache.clear()  # As after a restart, or in another worker
+            self.assertEqual(self.post_zip(make_zip(pages)).get_data(as_text=True), first)
+        self.assertEqual(app._vision_client.calls, 2)
+
+    def test_rejects_invalid_zip(self):
+        response = self.post_zip(io.BytesIO(b"not a zip"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("not a valid ZIP archive", response.get_data(as_text=True))
+
+
+class SubmitAsyncJobTests(unittest.TestCase):
+    def setUp(self):
+        self.operation = FakeOperation()
+        app._vision_client = mock.Mock()
+        app._vision_client.async_batch_annotate_images.return_value = self.operation
+        app._storage_client = mock.Mock()
+        patcher = mock.patch.object(app, 'GCS_BUCKET', 'test-bucket')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app._vision_client = None
+        app._storage_client = None
+
+    def submit(self, bucket: FakeBucket):
+        app._storage_client.bucket.return_value = bucket
+        archive = make_zip({'p1.png': png_bytes(1), 'p2.png': png_bytes(2)})
+        return self.client.post('/jobs', data={'file': (archive, 'comic.zip')}, content_type='multipart/form-data')
+
+    def test_failed_image_upload_returns_json_error(self):
+        bucket = FakeBucket(fail_on="p2.png")
+        response = self.submit(bucket)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("Could not upload images", response.get_json()["error"])
+        self.assertEqual(bucket.blobs, {})
+        app._vision_client.async_batch_annotate_images.assert_not_called()
+
+    def test_failed_manifest_write_cancels_the_operation(self):
+        bucket = FakeBucket(fail_on="job.json")
+        response = self.submit(bucket)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("Could not save OCR job", response.get_json()["error"])
+        self.assertTrue(self.operation.cancelled)
+        self.assertEqual(bucket.blobs, {})
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        for name, value in (('OCR_CACHE_DIR', self.cache_dir), ('OCR_CACHE_DIR_MAX_BYTES', 1000), ('_disk_cache_bytes', None)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app._ocr_cache.clear()
+
+    def test_prunes_least_recently_used_entries_over_the_limit(self):
+        keys = [f"{i:02d}" + "0" * 62 for i in range(10)]
+        for i, key in enumerate(keys):
+            app.cache_text(key, "x" * 200)
+            os.utime(app.ocr_cache_path(key), (i, i))  # Distinct, increasing mtimes
+
+        remaining = [key for key in keys if os.path.exists(app.ocr_cache_path(key))]
+        self.assertLessEqual(sum(size for _, size, _ in app.disk_cache_entries()), 1000)
+        self.assertIn(keys[-1], remaining)
+        self.assertNotIn(keys[0], remaining)
+
+    def test_read_back_preserves_line_endings(self):
+        key = "cd" + "0" * 62
+        app.cache_text(key, "line 1\r\nline 2\rline 3\n")
+        app._ocr_cache.clear()
+        self.assertEqual(app.get_cached_text(key), "line 1\r\nline 2\rline 3\n")
+
+    def test_failed_write_removes_temporary_file(self):
+        with mock.patch.object(app.os, 'replace', side_effect=OSError("disk full")):
+            app.cache_text("ab" + "0" * 62, "text")
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, "ab")), [])
+
+
+class AsyncJobStatusTests(unittest.TestCase):
+    job_id = "a" * 32
+
+    def setUp(self):
+        app._vision_client = mock.Mock()
+        self.get_operation = app._vision_client.transport.operations_client.get_operation
+        self.bucket = FakeBucket()
+        self.bucket.blobs[f"{self.job_id}/job.json"] = app.orjson.dumps(
+            {"operation": "operations/fake", "pages": [f"p{i}.png" for i in range(1, 4)]}
+        )
+        self.uploads = [f"{self.job_id}/in/{i:05d}-p{i + 1}.png" for i in range(3)]
+        for name in self.uploads:
+            self.bucket.blobs[name] = b"image"
+        app._storage_client = mock.Mock()
+        app._storage_client.bucket.return_value = self.bucket
+        patcher = mock.patch.object(app, 'GCS_BUCKET', 'test-bucket')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app._vision_client = None
+        app._storage_client = None
+
+    def write_output(self, name: str, texts: list[str]):
+        response = app.vision.BatchAnnotateImagesResponse(responses=[
+            app.vision.AnnotateImageResponse(full_text_annotation=app.vision.TextAnnotation(text=text)) for text in texts
+        ])
+        self.bucket.blobs[f"{self.job_id}/out/{name}"] = app.vision.BatchAnnotateImagesResponse.to_json(response).encode()
+
+    def status(self):
+        return self.client.get(f"/status/{self.job_id}")
+
+    def test_running_job(self):
+        self.get_operation.return_value = operations_pb2.Operation(done=False)
+        response = self.status()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["status"], "running")
+        self.assertTrue(all(name in self.bucket.blobs for name in self.uploads))
+
+    def test_done_job_returns_pages_in_output_file_order(self):
+        self.get_operation.return_value = operations_pb2.Operation(done=True)
+        # Listed out of order; output-10-... must sort after output-2-... despite comparing lower as a string.
+        self.write_output("output-10-to-10.json", ["third"])
+        self.write_output("output-1-to-1.json", ["first"])
+        self.write_output("output-2-to-9.json", ["second"])
+
+        body = self.status().get_json()
+        self.assertEqual(body["status"], "done")
+        self.assertEqual([page["text"] for page in body["pages"]], ["first", "second", "third"])
+        self.assertEqual([page["name"] for page in body["pages"]], ["p1.png", "p2.png", "p3.png"])
+        # Uploaded pages are dropped once the job is finished; the manifest and output are kept for later polls.
+        self.assertFalse(any(name.startswith(f"{self.job_id}/in/") for name in self.bucket.blobs))
+        self.assertIn(f"{self.job_id}/job.json", self.bucket.blobs)
+        self.assertEqual(self.status().get_json(), body)
+
+    def test_failed_job_is_a_successful_status_query(self):
+        self.get_operation.return_value = operations_pb2.Operation(done=True, error=status_pb2.Status(code=3, message="bad image"))
+        response = self.status()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"job_id": self.job_id, "status": "failed", "error": "bad image"})
+        self.assertFalse(any(name in self.bucket.blobs for name in self.uploads))
+
+    def test_operation_lookup_failure_returns_json_error(self):
+        self.get_operation.side_effect = RuntimeError("deadline exceeded")
+        response = self.status()
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("deadline exceeded", response.get_json()["error"])
+
+    def test_unreadable_output_returns_json_error(self):
+        self.get_operation.return_value = operations_pb2.Operation(done=True)
+        self.bucket.blobs[f"{self.job_id}/out/output-1-to-3.json"] = b"not json"
+        response = self.status()
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("Could not read OCR job results", response.get_json()["error"])
+
+    def test_unknown_job(self):
+        del self.bucket.blobs[f"{self.job_id}/job.json"]
+        self.assertEqual(self.status().status_code, 404)
+
+
+class ListImagePagesTests(unittest.TestCase):
+    def test_accepts_highly_compressible_bmp_pages(self):
+        # A mostly white BMP page deflates far beyond 100x and must not be mistaken for a zip bomb.
+        buf = io.BytesIO()
+        Image.new('RGB', (1600, 2400), 'white').save(buf, 'BMP')
+        archive = make_zip({f"page{i}.bmp": buf.getvalue() for i in range(5)}, zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(archive) as zip_ref:
+            self.assertEqual(len(app.list_image_pages(zip_ref)), 5)
+
+    def test_rejects_images_over_the_size_cap(self):
+        archive = make_zip({'p1.png': png_bytes(1), 'p2.png': png_bytes(2)})
+        with zipfile.ZipFile(archive) as zip_ref, mock.patch.object(app, 'MAX_ARCHIVE_IMAGE_BYTES', 10):
+            with self.assertRaises(ValueError):
+                app.list_image_pages(zip_ref)
+
+
+class PrepareForOcrTests(unittest.TestCase):
+    def downscaled_pixel(self, im: Image.Image):
+        buf = io.BytesIO()
+        im.save(buf, 'PNG')
+        with Image.open(io.BytesIO(app.prepare_for_ocr(buf.getvalue()))) as out:
+            self.assertLessEqual(max(out.size), app.OCR_MAX_DIMENSION)
+            return out.convert('RGB').getpixel((0, 0))
+
+    def test_transparent_background_becomes_white(self):
+        self.assertGreater(min(self.downscaled_pixel(Image.new('RGBA', (3000, 3000), (0, 0, 0, 0)))), 250)
+
+    def test_palette_transparency_becomes_white(self):
+        im = Image.new('P', (3000, 3000), 0)
+        im.putpalette([0, 0, 0] * 256)
+        im.info['transparency'] = 0
+        self.assertGreater(min(self.downscaled_pixel(im)), 250)
+
+    def test_small_images_are_sent_unchanged(self):
+        content = png_bytes(7)
+        self.assertIs(app.prepare_for_ocr(content), content)
+
+
+if __name__ == "__main__":
+    unittest.main()